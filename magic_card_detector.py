@@ -11,23 +11,38 @@ import pstats
 import io
 import pickle
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+from contextlib import nullcontext
 from copy import deepcopy
-from itertools import product
+from itertools import product, combinations, repeat
 from dataclasses import dataclass
 
 import numpy as np
 import matplotlib.pyplot as plt
 
-from shapely.geometry import LineString
 from shapely.geometry.polygon import Polygon
 from shapely.affinity import scale
-from scipy.ndimage import rotate
+
 from PIL import Image as PILImage
 
 import imagehash
 import cv2
 
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, the numeric kernels then run as plain python
+    def njit(*args, **kwargs):
+        """
+        Stand-in for numba.njit that returns the function unchanged.
+        """
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
 
+@njit(cache=True, nogil=True)
 def order_polygon_points(x, y):
     """
     Orders polygon points into a counterclockwise order.
@@ -38,15 +53,21 @@ def order_polygon_points(x, y):
     return (x[ind], y[ind])
 
 
+def poly_xy(poly):
+    """
+    Returns the exterior points of a polygon as an (N, 2) array,
+    without the closing point.
+    """
+    return np.asarray(poly.exterior.coords, dtype=np.float64)[:-1]
+
+
 def four_point_transform(image, poly):
     """
     A perspective transform for a quadrilateral polygon.
     Slightly modified version of the same function from
     https://github.com/EdjeElectronics/OpenCV-Playing-Card-Detector
     """
-    pts = np.zeros((4, 2))
-    pts[:, 0] = np.asarray(poly.exterior.coords)[:-1, 0]
-    pts[:, 1] = np.asarray(poly.exterior.coords)[:-1, 1]
+    pts = poly_xy(poly)
     # obtain a consistent order of the points and unpack them
     # individually
     rect = np.zeros((4, 2))
@@ -92,37 +113,48 @@ def four_point_transform(image, poly):
 
     # compute the perspective transform matrix and then apply it
     transform = cv2.getPerspectiveTransform(rect, dst)
+
+    # Only the region of the image around the quadrilateral is warped,
+    # with a margin for the interpolation at the edges.
+    (x_0, y_0, roi_width, roi_height) = cv2.boundingRect(rect)
+    x_1 = min(x_0 + roi_width + 2, image.shape[1])
+    y_1 = min(y_0 + roi_height + 2, image.shape[0])
+    x_0 = max(x_0 - 2, 0)
+    y_0 = max(y_0 - 2, 0)
+    if x_1 > x_0 and y_1 > y_0:
+        image = image[y_0:y_1, x_0:x_1]
+        transform = transform @ np.array([[1., 0., x_0],
+                                          [0., 1., y_0],
+                                          [0., 0., 1.]])
     warped = cv2.warpPerspective(image, transform, (max_width, max_height))
 
     # return the warped image
     return warped
 
 
-def line_intersection(x, y):
+@njit(cache=True, nogil=True, inline='always')
+def line_intersection_scalar(x_0, x_1, x_2, x_3, y_0, y_1, y_2, y_3):
     """
     Calculates the intersection point of two lines, defined by the points
-    (x1, y1) and (x2, y2) (first line), and
-    (x3, y3) and (x4, y4) (second line).
+    (x_0, y_0) and (x_1, y_1) (first line), and
+    (x_2, y_2) and (x_3, y_3) (second line).
     If the lines are parallel, (nan, nan) is returned.
     """
-    slope_0 = (x[0] - x[1]) * (y[2] - y[3])
-    slope_2 = (y[0] - y[1]) * (x[2] - x[3])
+    slope_0 = (x_0 - x_1) * (y_2 - y_3)
+    slope_2 = (y_0 - y_1) * (x_2 - x_3)
     if slope_0 == slope_2:
         # parallel lines
-        xis = np.nan
-        yis = np.nan
-    else:
-        xy_01 = x[0] * y[1] - y[0] * x[1]
-        xy_23 = x[2] * y[3] - y[2] * x[3]
-        denom = slope_0 - slope_2
-
-        xis = (xy_01 * (x[2] - x[3]) - (x[0] - x[1]) * xy_23) / denom
-        yis = (xy_01 * (y[2] - y[3]) - (y[0] - y[1]) * xy_23) / denom
+        return (np.nan, np.nan)
+    xy_01 = x_0 * y_1 - y_0 * x_1
+    xy_23 = x_2 * y_3 - y_2 * x_3
+    denom = slope_0 - slope_2
 
+    xis = (xy_01 * (x_2 - x_3) - (x_0 - x_1) * xy_23) / denom
+    yis = (xy_01 * (y_2 - y_3) - (y_0 - y_1) * xy_23) / denom
     return (xis, yis)
 
 
-def simplify_polygon(in_poly,
+def simplify_polygon(xy_in,
                      length_cutoff=0.15,
                      maxiter=None,
                      segment_to_remove=None):
@@ -130,87 +162,158 @@ def simplify_polygon(in_poly,
     Removes segments from a (convex) polygon by continuing neighboring
     segments to a new point of intersection. Purpose is to approximate
     rounded polygons (quadrilaterals) with more sharp-cornered ones.
+    The polygon points are given and returned as (N, 2) arrays.
     """
+    if segment_to_remove is not None:
+        maxiter = 1
+    (x_in, y_in) = simplify_polygon_points(
+        xy_in[:, 0].copy(),
+        xy_in[:, 1].copy(),
+        length_cutoff,
+        -1 if maxiter is None else maxiter,
+        -1 if segment_to_remove is None else segment_to_remove)
+
+    return np.column_stack((x_in, y_in))
 
-    x_in = np.asarray(in_poly.exterior.coords)[:-1, 0]
-    y_in = np.asarray(in_poly.exterior.coords)[:-1, 1]
+
+@njit(cache=True, nogil=True)
+def simplify_polygon_points(x_in, y_in, length_cutoff, maxiter,
+                            segment_to_remove):
+    """
+    Numeric core of simplify_polygon, operating on the x and y coordinates
+    of the polygon points. Negative maxiter and segment_to_remove
+    correspond to None in simplify_polygon.
+    """
     len_poly = len(x_in)
     niter = 0
-    if segment_to_remove is not None:
-        maxiter = 1
+    # segment lengths and the total length are only calculated once,
+    # and updated for the segments that change when one is removed
+    d_in = np.sqrt(np.ediff1d(x_in, to_end=x_in[0] - x_in[-1]) ** 2. +
+                   np.ediff1d(y_in, to_end=y_in[0] - y_in[-1]) ** 2.)
+    d_tot = np.sum(d_in)
     while len_poly > 4:
-        d_in = np.sqrt(np.ediff1d(x_in, to_end=x_in[0] - x_in[-1]) ** 2. +
-                       np.ediff1d(y_in, to_end=y_in[0] - y_in[-1]) ** 2.)
-        d_tot = np.sum(d_in)
-        if segment_to_remove is not None:
+        if segment_to_remove >= 0:
             k = segment_to_remove
         else:
             k = np.argmin(d_in)
         if d_in[k] < length_cutoff * d_tot:
-            ind = generate_point_indices(k - 1, k + 1, len_poly)
-            (xis, yis) = line_intersection(x_in[ind], y_in[ind])
+            i_0 = (k - 1) % len_poly
+            i_1 = k % len_poly
+            i_2 = (k + 1) % len_poly
+            i_3 = (k + 2) % len_poly
+            (xis, yis) = line_intersection_scalar(
+                x_in[i_0], x_in[i_1], x_in[i_2], x_in[i_3],
+                y_in[i_0], y_in[i_1], y_in[i_2], y_in[i_3])
             x_in[k] = xis
             y_in[k] = yis
             x_in = np.delete(x_in, (k + 1) % len_poly)
             y_in = np.delete(y_in, (k + 1) % len_poly)
+            d_tot -= (d_in[(k - 1) % len_poly] + d_in[k] +
+                      d_in[(k + 1) % len_poly])
+            d_in = np.delete(d_in, (k + 1) % len_poly)
             len_poly = len(x_in)
+            # the new intersection point and its neighbors
+            k_new = k if k < len_poly else k - 1
+            for i_seg in ((k_new - 1) % len_poly, k_new):
+                i_next = (i_seg + 1) % len_poly
+                d_in[i_seg] = np.sqrt((x_in[i_next] - x_in[i_seg]) ** 2. +
+                                      (y_in[i_next] - y_in[i_seg]) ** 2.)
+                d_tot += d_in[i_seg]
             niter += 1
-            if (maxiter is not None) and (niter >= maxiter):
+            if 0 <= maxiter <= niter:
                 break
         else:
             break
 
-    out_poly = Polygon([[ix, iy] for (ix, iy) in zip(x_in, y_in)])
-
-    return out_poly
+    return (x_in, y_in)
 
 
-def generate_point_indices(index_1, index_2, max_len):
+def line_intersections_batch(x, y):
     """
-    Returns the four indices that give the end points of
-    polygon segments corresponding to index_1 and index_2,
-    modulo the number of points (max_len).
+    Vectorized version of line_intersection_scalar.
+    x and y are (K, 4) arrays, each row holding the points
+    (x1, y1), (x2, y2) of the first line and
+    (x3, y3), (x4, y4) of the second line.
+    Returns two (K,) arrays of intersection points, with nan
+    for parallel lines.
     """
-    return np.array([index_1 % max_len,
-                     (index_1 + 1) % max_len,
-                     index_2 % max_len,
-                     (index_2 + 1) % max_len])
+    denom = ((x[:, 0] - x[:, 1]) * (y[:, 2] - y[:, 3]) -
+             (y[:, 0] - y[:, 1]) * (x[:, 2] - x[:, 3]))
+    parallel = denom == 0.
+    xy_01 = x[:, 0] * y[:, 1] - y[:, 0] * x[:, 1]
+    xy_23 = x[:, 2] * y[:, 3] - y[:, 2] * x[:, 3]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xis = np.where(parallel, np.nan,
+                       (xy_01 * (x[:, 2] - x[:, 3]) -
+                        (x[:, 0] - x[:, 1]) * xy_23) / denom)
+        yis = np.where(parallel, np.nan,
+                       (xy_01 * (y[:, 2] - y[:, 3]) -
+                        (y[:, 0] - y[:, 1]) * xy_23) / denom)
+    return (xis, yis)
 
 
 def generate_quad_corners(indices, x, y):
     """
-    Returns the four intersection points from the
+    Returns the intersection points from the
     segments defined by the x coordinates (x),
     y coordinates (y), and the indices.
+    indices is a (K, 4) array of segment indices (i, j, k, l), and
+    the four corners of each candidate are the intersections of
+    the segment pairs (i, j), (j, k), (k, l) and (l, i).
+    Returns two (K, 4) arrays.
     """
-    (i, j, k, l) = indices
+    n_quads = len(indices)
+    # segment pairs of all candidates, (K * 4, 2)
+    pairs = np.stack((indices, np.roll(indices, -1, axis=1)),
+                     axis=2).reshape(-1, 2)
+    # end point indices of the segment pairs, (K * 4, 4)
+    ind = np.column_stack((pairs[:, 0], pairs[:, 0] + 1,
+                           pairs[:, 1], pairs[:, 1] + 1)) % len(x)
+    (xis, yis) = line_intersections_batch(x[ind], y[ind])
 
-    def gpi(index_1, index_2):
-        return generate_point_indices(index_1, index_2, len(x))
+    return (xis.reshape(n_quads, 4), yis.reshape(n_quads, 4))
 
-    xis = np.empty(4)
-    yis = np.empty(4)
-    xis.fill(np.nan)
-    yis.fill(np.nan)
 
-    if j <= i or k <= j or l <= k:
-        pass
-    else:
-        (xis[0], yis[0]) = line_intersection(x[gpi(i, j)],
-                                             y[gpi(i, j)])
-        (xis[1], yis[1]) = line_intersection(x[gpi(j, k)],
-                                             y[gpi(j, k)])
-        (xis[2], yis[2]) = line_intersection(x[gpi(k, l)],
-                                             y[gpi(k, l)])
-        (xis[3], yis[3]) = line_intersection(x[gpi(l, i)],
-                                             y[gpi(l, i)])
-
-    return (xis, yis)
+@njit(cache=True, nogil=True)
+def points_in_quad(quad_xy, pts_xy, tol=1.e-9):
+    """
+    Returns whether all the points (pts_xy, (N, 2)) are inside or
+    on the edge of the quadrilateral (quad_xy, (4, 2)).
+    Uses the crossing number test, with points within tol from
+    an edge counted as inside.
+    """
+    for i_pt in range(pts_xy.shape[0]):
+        p_x = pts_xy[i_pt, 0]
+        p_y = pts_xy[i_pt, 1]
+        inside = False
+        for i in range(4):
+            x_0 = quad_xy[i, 0]
+            y_0 = quad_xy[i, 1]
+            x_1 = quad_xy[(i + 1) % 4, 0]
+            y_1 = quad_xy[(i + 1) % 4, 1]
+            # on the edge (replaces the touches check)
+            d_x = x_1 - x_0
+            d_y = y_1 - y_0
+            len_sq = d_x * d_x + d_y * d_y
+            t_edge = ((p_x - x_0) * d_x + (p_y - y_0) * d_y) / len_sq
+            cross = d_x * (p_y - y_0) - d_y * (p_x - x_0)
+            if (0. <= t_edge <= 1. and
+                    cross * cross <= tol * tol * len_sq):
+                inside = True
+                break
+            # crossing of a ray towards +x
+            if (y_0 > p_y) != (y_1 > p_y):
+                if p_x < x_0 + (p_y - y_0) * d_x / d_y:
+                    inside = not inside
+        if not inside:
+            return False
+    return True
 
 
-def generate_quad_candidates(in_poly):
+def generate_quad_candidates(xy_in):
     """
-    Generates a list of bounding quadrilaterals for a polygon,
+    Generates a list of bounding quadrilaterals, as (4, 2) arrays of
+    corner points, for a polygon (given as an (N, 2) array of points),
     using all possible combinations of four intersection points
     derived from four extended polygon segments.
     The number of combinations increases rapidly with the order
@@ -218,62 +321,65 @@ def generate_quad_candidates(in_poly):
     remove very short segments from the polygon.
     """
     # make sure that the points are ordered
-    (x_s, y_s) = order_polygon_points(
-        np.asarray(in_poly.exterior.coords)[:-1, 0],
-        np.asarray(in_poly.exterior.coords)[:-1, 1])
+    (x_s, y_s) = order_polygon_points(xy_in[:, 0], xy_in[:, 1])
     x_s_ave = np.average(x_s)
     y_s_ave = np.average(y_s)
     x_shrunk = x_s_ave + 0.9999 * (x_s - x_s_ave)
     y_shrunk = y_s_ave + 0.9999 * (y_s - y_s_ave)
-    shrunk_poly = Polygon([[x, y] for (x, y) in
-                           zip(x_shrunk, y_shrunk)])
+    shrunk_xy = np.column_stack((x_shrunk, y_shrunk))
     quads = []
     len_poly = len(x_s)
 
-    for indices in product(range(len_poly), repeat=4):
-        (xis, yis) = generate_quad_corners(indices, x_s, y_s)
-        if (np.sum(np.isnan(xis)) + np.sum(np.isnan(yis))) > 0:
-            # no intersection point for some of the lines
-            pass
-        else:
-            (xis, yis) = order_polygon_points(xis, yis)
-            enclose = True
-            quad = Polygon([(xis[0], yis[0]),
-                            (xis[1], yis[1]),
-                            (xis[2], yis[2]),
-                            (xis[3], yis[3])])
-            if not quad.contains(shrunk_poly):
-                enclose = False
-            if enclose:
-                quads.append(quad)
+    indices = np.array(list(combinations(range(len_poly), 4)),
+                       dtype=int).reshape(-1, 4)
+    (xis_all, yis_all) = generate_quad_corners(indices, x_s, y_s)
+    # drop the candidates with no intersection point for some of the lines
+    valid = ~np.any(np.isnan(xis_all) | np.isnan(yis_all), axis=1)
+
+    for (xis, yis) in zip(xis_all[valid], yis_all[valid]):
+        (xis, yis) = order_polygon_points(xis, yis)
+        quad_xy = np.column_stack((xis, yis))
+        if points_in_quad(quad_xy, shrunk_xy):
+            quads.append(quad_xy)
     return quads
 
 
-def get_bounding_quad(hull_poly):
+def get_bounding_quad(hull_xy):
     """
     Returns the minimum area quadrilateral that contains (bounds)
-    the convex hull (openCV format) given as input.
+    the convex hull (see convex_hull_polygon) given as input.
     """
-    simple_poly = simplify_polygon(hull_poly)
-    bounding_quads = generate_quad_candidates(simple_poly)
-    bquad_areas = np.zeros(len(bounding_quads))
-    for iquad, bquad in enumerate(bounding_quads):
-        bquad_areas[iquad] = bquad.area
-    min_area_quad = bounding_quads[np.argmin(bquad_areas)]
+    return Polygon(get_bounding_quad_points(hull_xy))
+
+
+def get_bounding_quad_points(hull_xy):
+    """
+    Returns the corner points, as a (4, 2) array, of the minimum area
+    quadrilateral that contains (bounds) the convex hull given as input.
+    """
+    simple_poly = simplify_polygon(hull_xy)
+    min_area_quad = None
+    min_area = np.inf
+    for bquad in generate_quad_candidates(simple_poly):
+        bquad_area = polygon_area(bquad)
+        if bquad_area < min_area:
+            min_area_quad = bquad
+            min_area = bquad_area
+    if min_area_quad is None:
+        raise ValueError('No bounding quadrilateral found.')
 
     return min_area_quad
 
 
-def quad_corner_diff(hull_poly, bquad_poly, region_size=0.9):
+def quad_corner_diff(hull_xy, bquad_poly, region_size=0.9):
     """
     Returns the difference between areas in the corners of a rounded
-    corner and the aproximating sharp corner quadrilateral.
+    corner (convex hull points, hull_xy) and the aproximating sharp corner
+    quadrilateral.
     region_size (param) determines the region around the corner where
     the comparison is done.
     """
-    bquad_corners = np.zeros((4, 2))
-    bquad_corners[:, 0] = np.asarray(bquad_poly.exterior.coords)[:-1, 0]
-    bquad_corners[:, 1] = np.asarray(bquad_poly.exterior.coords)[:-1, 1]
+    bquad_corners = poly_xy(bquad_poly)
 
     # The point inside the quadrilateral, region_size towards the quad center
     interior_points = np.zeros((4, 2))
@@ -298,18 +404,51 @@ def quad_corner_diff(hull_poly, bquad_poly, region_size=0.9):
     p1_y = interior_points[:, 1] + \
         (bquad_corners[:, 0] - np.average(bquad_corners[:, 0]))
 
-    corner_area_polys = []
-    for i in range(len(interior_points[:, 0])):
-        bline = LineString([(p0_x[i], p0_y[i]), (p1_x[i], p1_y[i])])
-        corner_area_polys.append(Polygon(
-            [bquad_poly.intersection(bline).coords[0],
-             bquad_poly.intersection(bline).coords[1],
-             (bquad_corners[i, 0], bquad_corners[i, 1])]))
-
+    # Intersections of the lines (p0, p1) with the extended quad edges,
+    # all four corners times all four edges at once.
+    edge_x = np.column_stack((bquad_corners[:, 0],
+                              np.roll(bquad_corners[:, 0], -1)))
+    edge_y = np.column_stack((bquad_corners[:, 1],
+                              np.roll(bquad_corners[:, 1], -1)))
+    line_x = np.repeat(np.column_stack((p0_x, p1_x)), 4, axis=0)
+    line_y = np.repeat(np.column_stack((p0_y, p1_y)), 4, axis=0)
+    (xis, yis) = line_intersections_batch(
+        np.hstack((line_x, np.tile(edge_x, (4, 1)))),
+        np.hstack((line_y, np.tile(edge_y, (4, 1)))))
+
+    # Keep the intersections that are on the quad edges, and clip the
+    # line to the quad (and to the (p0, p1) segment itself).
+    edge_dx = np.tile(edge_x[:, 1] - edge_x[:, 0], 4)
+    edge_dy = np.tile(edge_y[:, 1] - edge_y[:, 0], 4)
+    t_edge = ((xis - np.tile(edge_x[:, 0], 4)) * edge_dx +
+              (yis - np.tile(edge_y[:, 0], 4)) * edge_dy) / \
+        (edge_dx ** 2 + edge_dy ** 2)
+    on_edge = ((t_edge >= -1.e-9) & (t_edge <= 1. + 1.e-9)).reshape(4, 4)
+    if not np.all(np.any(on_edge, axis=1)):
+        raise ValueError('Corner line does not intersect the quadrilateral.')
+    line_dx = line_x[:, 1] - line_x[:, 0]
+    line_dy = line_y[:, 1] - line_y[:, 0]
+    t_line = (((xis - line_x[:, 0]) * line_dx +
+               (yis - line_y[:, 0]) * line_dy) /
+              (line_dx ** 2 + line_dy ** 2)).reshape(4, 4)
+    t_0 = np.clip(np.amin(np.where(on_edge, t_line, np.inf), axis=1), 0., 1.)
+    t_1 = np.clip(np.amax(np.where(on_edge, t_line, -np.inf), axis=1), 0., 1.)
+    a_x = p0_x + t_0 * (p1_x - p0_x)
+    a_y = p0_y + t_0 * (p1_y - p0_y)
+    b_x = p0_x + t_1 * (p1_x - p0_x)
+    b_y = p0_y + t_1 * (p1_y - p0_y)
+
+    # Area of the corner triangles (a, b, corner)
+    quad_corner_area = np.sum(0.5 * np.abs(
+        (b_x - a_x) * (bquad_corners[:, 1] - a_y) -
+        (b_y - a_y) * (bquad_corners[:, 0] - a_x)))
+
+    hull_poly = Polygon(hull_xy)
     hull_corner_area = 0
-    quad_corner_area = 0
-    for capoly in corner_area_polys:
-        quad_corner_area += capoly.area
+    for i in range(len(bquad_corners)):
+        capoly = Polygon([(a_x[i], a_y[i]),
+                          (b_x[i], b_y[i]),
+                          (bquad_corners[i, 0], bquad_corners[i, 1])])
         hull_corner_area += capoly.intersection(hull_poly).area
 
     return 1. - hull_corner_area / quad_corner_area
@@ -317,12 +456,21 @@ def quad_corner_diff(hull_poly, bquad_poly, region_size=0.9):
 
 def convex_hull_polygon(contour):
     """
-    Returns the convex hull of the given contour as a polygon.
+    Returns the convex hull of the given contour as a polygon,
+    given as an (N, 2) array of points.
+    """
+    hull = cv2.convexHull(contour).reshape(-1, 2).astype(np.float64)
+    if len(hull) < 3:
+        raise ValueError('The convex hull has less than 3 points.')
+    return hull
+
+
+def polygon_area(xy_p):
+    """
+    Returns the area of a polygon given as an (N, 2) array of points.
     """
-    hull = cv2.convexHull(contour)
-    phull = Polygon([[x, y] for (x, y) in
-                     zip(hull[:, :, 0], hull[:, :, 1])])
-    return phull
+    return 0.5 * abs(np.dot(xy_p[:, 0], np.roll(xy_p[:, 1], -1)) -
+                     np.dot(xy_p[:, 1], np.roll(xy_p[:, 0], -1)))
 
 
 def polygon_form_factor(poly):
@@ -330,22 +478,62 @@ def polygon_form_factor(poly):
     The ratio between the polygon area and circumference length,
     scaled by the length of the shortest segment.
     """
+    xy_p = np.asarray(poly.exterior.coords, dtype=np.float64)
+    return polygon_points_form_factor(xy_p[:, 0].copy(), xy_p[:, 1].copy())
+
+
+@njit(cache=True, nogil=True)
+def polygon_points_form_factor(x, y):
+    """
+    Numeric core of polygon_form_factor, operating on the x and y
+    coordinates of the closed exterior ring of the polygon.
+    """
+    d_x = np.diff(x)
+    d_y = np.diff(y)
+    d_in = np.sqrt(d_x ** 2. + d_y ** 2.)
+    # shoelace formula for the area
+    area = 0.5 * np.abs(np.sum(x[:-1] * y[1:] - x[1:] * y[:-1]))
     # minimum side length
-    d_0 = np.amin(np.sqrt(np.sum(np.diff(np.asarray(poly.exterior.coords),
-                                         axis=0) ** 2., axis=1)))
-    return poly.area / (poly.length * d_0)
+    return area / (np.sum(d_in) * np.amin(d_in))
+
+
+def bound_card_contour(card_contour, image_area):
+    """
+    Calculates the convex hull of a contour and, if the hull is large
+    enough for a card, the corner points of the bounding quadrilateral.
+    Only numpy, OpenCV and the jitted kernels are used here, no shapely,
+    since this is run in threads (see segment_image) and shapely 1.8
+    shares a single GEOS context between the threads.
+    Errors from the bounding quadrilateral are returned instead of raised,
+    since characterize_card_contour decides if the quadrilateral is used.
+    """
+    hull_xy = convex_hull_polygon(card_contour)
+    hull_area = polygon_area(hull_xy)
+    bquad_xy = None
+    error = None
+    if hull_area >= image_area / 1000.:
+        try:
+            bquad_xy = get_bounding_quad_points(hull_xy)
+        except ValueError as err:
+            error = err
+    return (hull_xy, hull_area, bquad_xy, error)
 
 
 def characterize_card_contour(card_contour,
                               max_segment_area,
-                              image_area):
+                              image_area,
+                              bounded_contour=None):
     """
     Calculates a bounding polygon for a contour, in addition
     to several charasteristic parameters.
+    bounded_contour is the result of bound_card_contour for the contour,
+    if already calculated.
     """
-    phull = convex_hull_polygon(card_contour)
-    if (phull.area < 0.1 * max_segment_area or
-            phull.area < image_area / 1000.):
+    if bounded_contour is None:
+        bounded_contour = bound_card_contour(card_contour, image_area)
+    (hull_xy, hull_area, bquad_xy, error) = bounded_contour
+    if (hull_area < 0.1 * max_segment_area or
+            hull_area < image_area / 1000.):
         # break after card size range has been explored
         continue_segmentation = False
         is_card_candidate = False
@@ -354,9 +542,11 @@ def characterize_card_contour(card_contour,
         print("Card size range explored")
     else:
         print("Possible card")
+        if error is not None:
+            raise error
         continue_segmentation = True
-        bounding_poly = get_bounding_quad(phull)
-        qc_diff = quad_corner_diff(phull, bounding_poly)
+        bounding_poly = Polygon(bquad_xy)
+        qc_diff = quad_corner_diff(hull_xy, bounding_poly)
         crop_factor = min(1., (1. - qc_diff * 22. / 100.))
 #        print("bounding_poly.area: " + str(bounding_poly.area) + " qc_diff: " + str(qc_diff) + " polygon_form_factor: " + str(polygon_form_factor(bounding_poly)))
 #        print("bool bounding_poly: " + str(bool( 0.1 * max_segment_area < bounding_poly.area < image_area * 0.99)))
@@ -375,6 +565,194 @@ def characterize_card_contour(card_contour,
             bounding_poly,
             crop_factor)
 
+def phash_dct(image, hash_size=32, highfreq_factor=4):
+    """
+    Calculates the low frequency DCT block (hash_size x hash_size) from
+    which the perceptive hash (as imagehash.phash) of the image is derived.
+    The grayscale conversion and the downsampling are done with PIL as in
+    imagehash.phash, so that the hashes match the stored reference hashes.
+    """
+    img_size = hash_size * highfreq_factor
+    # The multiplication wraps around in uint8 (inverts the image).
+    # It is kept, since the stored reference hashes are calculated
+    # from the same image.
+    pixels = np.asarray(
+        PILImage.fromarray(np.ascontiguousarray(
+            np.uint8(255 * image)[:, :, ::-1])).convert('L').resize(
+                (img_size, img_size), PILImage.LANCZOS),
+        dtype=np.float64)
+    dct = cv2.dct(pixels)
+    # scale the orthonormal DCT as the unnormalized one of imagehash.phash
+    dct[0, :] *= np.sqrt(2.)
+    dct[:, 0] *= np.sqrt(2.)
+    return dct[:hash_size, :hash_size]
+
+
+def dct_phashes(dct_low_freq, rotations=(0., 90., 180., 270.)):
+    """
+    Calculates the perceptive hashes of an image rotated by each of the
+    given rotations (multiples of 90 degrees), from the low frequency DCT
+    block of the unrotated image (see phash_dct). Rotating the image by
+    90 degrees transposes the DCT and flips the sign of its odd rows.
+    """
+    hash_size = len(dct_low_freq)
+    sign = (-1.) ** np.arange(hash_size)[:, np.newaxis]
+    dct_rotated = np.empty((len(rotations), hash_size, hash_size))
+    for i, rot in enumerate(rotations):
+        dct_rotated[i] = dct_low_freq
+        for _ in range(int(round(rot / 90.)) % 4):
+            dct_rotated[i] = sign * dct_rotated[i].T
+    med = np.median(dct_rotated.reshape(len(rotations), -1), axis=1)
+    return dct_rotated > med[:, np.newaxis, np.newaxis]
+
+
+def phash_rotations(image, rotations=(0., 90., 180., 270.),
+                    hash_size=32, highfreq_factor=4):
+    """
+    Calculates the perceptive hash (as imagehash.phash) of the image
+    rotated by each of the given rotations (multiples of 90 degrees).
+    The DCT is calculated for the image and for the image rotated by
+    90 degrees (the downsampling of a non-square image depends on its
+    orientation), the half turns are derived from these.
+    """
+    dct_low_freq = {}
+    hashes = []
+    for rot in rotations:
+        quarter = int(round(rot / 90.)) % 2
+        if quarter not in dct_low_freq:
+            dct_low_freq[quarter] = phash_dct(np.rot90(image, k=quarter),
+                                              hash_size, highfreq_factor)
+        hashes.append(dct_phashes(dct_low_freq[quarter],
+                                  (rot - 90. * quarter,))[0])
+    return np.stack(hashes)
+
+
+def pack_hashes(hashes):
+    """
+    Packs boolean hash arrays, shape (K, hash_size, hash_size), into
+    rows of 64-bit words, shape (K, hash_size**2 / 64).
+    """
+    hashes = np.asarray(hashes, dtype=bool).reshape(len(hashes), -1)
+    return np.packbits(hashes, axis=1).view(np.uint64)
+
+
+# number of set bits in each byte value
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)],
+                          dtype=np.uint8)
+
+
+def hamming_distances(packed_hashes, packed_hash):
+    """
+    Returns the Hamming distances between each row of packed_hashes
+    (K, n_words) and packed_hash (n_words,), as given by pack_hashes.
+    """
+    xor = np.bitwise_xor(packed_hashes, packed_hash)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(xor).sum(axis=-1, dtype=np.int64)
+    # numpy < 2.0
+    return POPCOUNT_TABLE[xor.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def phash_recognize(im_seg, ref_hashes, ref_names, hash_separation_thr,
+                    verbose=False):
+    """
+    Runs perceptive hash comparison between given image and
+    the reference set, given as the packed reference hashes
+    (see pack_hashes) and the corresponding card names.
+    """
+    card_name = 'unknown'
+    is_recognized = False
+    recognition_score = 0.
+    recognition_rotation: float = 0.
+    rotations = np.array([0., 90., 180., 270.])
+
+    phash_im = pack_hashes(phash_rotations(im_seg, rotations))
+    # distances of all the references (rows) to all the rotations (columns)
+    d_0 = hamming_distances(ref_hashes[:, None, :], phash_im[None, :, :])
+    d_0_min = np.amin(d_0, axis=0)
+    d_0_mask = d_0 > d_0_min
+    d_0_count = np.sum(d_0_mask, axis=0)
+    d_0_ave = np.sum(d_0, axis=0, where=d_0_mask) / d_0_count
+    d_0_std = np.sqrt(np.sum((d_0 - d_0_ave)**2, axis=0,
+                             where=d_0_mask) / d_0_count)
+    d_0_dist = (d_0_ave - d_0_min) / d_0_std
+
+    # The rotations are tried in order: the first one that separates
+    # the best match clearly, and better than the preceding rotations,
+    # is accepted.
+    d_0_prev_max = np.maximum.accumulate(
+        np.concatenate(([-np.inf], d_0_dist[:-1])))
+    accepted = (d_0_dist > hash_separation_thr) & (d_0_dist > d_0_prev_max)
+    n_tried = np.argmax(accepted) + 1 if np.any(accepted) else len(rotations)
+    if verbose:
+        for j in range(n_tried):
+            print('Phash statistical distance: ' + str(d_0_dist[j]))
+    if np.any(accepted):
+        j = n_tried - 1
+        card_name = ref_names[np.argmin(d_0[:, j])]
+        is_recognized = True
+        recognition_score = d_0_dist[j] / hash_separation_thr
+        recognition_rotation = rotations[j]
+    return (is_recognized, recognition_score, card_name, recognition_rotation)
+
+
+# Reference data of a recognition worker process,
+# set by init_recognition_worker.
+WORKER_REFERENCE = {}
+
+
+def init_recognition_worker(ref_hashes, ref_names, hash_separation_thr,
+                            verbose):
+    """
+    Initializer of the recognition worker processes. The reference data
+    is passed once per process instead of once per candidate.
+    """
+    WORKER_REFERENCE['ref_hashes'] = ref_hashes
+    WORKER_REFERENCE['ref_names'] = ref_names
+    WORKER_REFERENCE['hash_separation_thr'] = hash_separation_thr
+    WORKER_REFERENCE['verbose'] = verbose
+
+
+def recognize_segment_worker(im_seg):
+    """
+    Recognizes an image segment in a worker process.
+    """
+    return phash_recognize(im_seg, **WORKER_REFERENCE)
+
+
+def read_reference_image_worker(path, filename, clip_limit, tile_grid_size,
+                                keep_images=True):
+    """
+    Reads, adjusts and hashes a reference image in a worker process.
+    The CLAHE object is created in the worker from the given parameters.
+    Without keep_images, only the name and the phash are sent back.
+    """
+    clahe = cv2.createCLAHE(clipLimit=clip_limit,
+                            tileGridSize=tile_grid_size)
+    image = ReferenceImage(filename.split(path)[1], cv2.imread(filename),
+                           clahe)
+    if not keep_images:
+        image.original = image.clahe = image.adjusted = None
+    return image
+
+
+def warmup_numeric_kernels():
+    """
+    Runs the jit-compiled numeric kernels once on a small polygon,
+    so that the compilation is not done in the middle of segmentation.
+    """
+    x_p = np.array([0., 2., 2.2, 2., 0.])
+    y_p = np.array([0., 0., 1., 2., 2.])
+    order_polygon_points(x_p, y_p)
+    simplify_polygon_points(x_p.copy(), y_p.copy(), 0.15, -1, -1)
+    points_in_quad(np.column_stack((x_p[:4], y_p[:4])),
+                   np.column_stack((x_p, y_p)))
+    polygon_points_form_factor(np.append(x_p, x_p[0]),
+                               np.append(y_p, y_p[0]))
+
+
+warmup_numeric_kernels()
+
 #
 # CLASSES
 #
@@ -403,14 +781,6 @@ class CardCandidate:
     #    self.image_area_fraction = fraction
     #    self.name = 'unknown'
 
-    def contains(self, other):
-        """
-        Returns whether the bounding polygon of the card candidate
-        contains the bounding polygon of the other candidate.
-        """
-        return bool(other.bounding_quad.within(self.bounding_quad) and
-                    other.name == self.name)
-
 
 class ReferenceImage:
     """
@@ -432,20 +802,16 @@ class ReferenceImage:
         """
         Calculates the perceptive hash for the image
         """
-        self.phash = imagehash.phash(
-            PILImage.fromarray(np.uint8(255 * cv2.cvtColor(
-                self.adjusted, cv2.COLOR_BGR2RGB))),
-            hash_size=32)
+        self.phash = imagehash.ImageHash(
+            phash_rotations(self.adjusted, rotations=(0.,))[0])
 
     def histogram_adjust(self):
         """
         Adjusts the image by contrast limited histogram adjustmend (clahe)
         """
         lab = cv2.cvtColor(self.original, cv2.COLOR_BGR2LAB)
-        lightness, redness, yellowness = cv2.split(lab)
-        corrected_lightness = self.clahe.apply(lightness)
-        limg = cv2.merge((corrected_lightness, redness, yellowness))
-        self.adjusted = cv2.cvtColor(limg, cv2.COLOR_LAB2BGR)
+        lab[:, :, 0] = self.clahe.apply(lab[:, :, 0])
+        self.adjusted = cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
 
 
 class TestImage:
@@ -470,10 +836,8 @@ class TestImage:
         Adjusts the image by contrast limited histogram adjustmend (clahe)
         """
         lab = cv2.cvtColor(self.original, cv2.COLOR_BGR2LAB)
-        lightness, redness, yellowness = cv2.split(lab)
-        corrected_lightness = self.clahe.apply(lightness)
-        limg = cv2.merge((corrected_lightness, redness, yellowness))
-        self.adjusted = cv2.cvtColor(limg, cv2.COLOR_LAB2BGR)
+        lab[:, :, 0] = self.clahe.apply(lab[:, :, 0])
+        self.adjusted = cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
 
     def mark_fragments(self):
         """
@@ -504,10 +868,13 @@ class TestImage:
                         else:
                             candidate.is_fragment = True
 
-    def plot_image_with_recognized(self, output_path, visual=False):
+    def plot_image_with_recognized(self, output_path, visual=False,
+                                   save=True):
         """
         Plots the recognized cards into the full image.
         """
+        if not visual and not save:
+            return
         # Plotting
         plt.figure()
         plt.imshow(cv2.cvtColor(self.original, cv2.COLOR_BGR2RGB))
@@ -515,20 +882,14 @@ class TestImage:
         for candidate in self.candidate_list:
             if not candidate.is_fragment:
                 full_image = self.adjusted
-                bquad_corners = np.empty((4, 2))
-                bquad_corners[:, 0] = np.asarray(
-                    candidate.bounding_quad.exterior.coords)[:-1, 0]
-                bquad_corners[:, 1] = np.asarray(
-                    candidate.bounding_quad.exterior.coords)[:-1, 1]
+                bquad_corners = poly_xy(candidate.bounding_quad)
 
                 plt.plot(np.append(bquad_corners[:, 0],
                                    bquad_corners[0, 0]),
                          np.append(bquad_corners[:, 1],
                                    bquad_corners[0, 1]), 'g-')
-                bounding_poly = Polygon([[x, y] for (x, y) in
-                                         zip(bquad_corners[:, 0],
-                                             bquad_corners[:, 1])])
-                fntsze = int(6 * bounding_poly.length / full_image.shape[1])
+                fntsze = int(6 * candidate.bounding_quad.length /
+                             full_image.shape[1])
                 bbox_color = 'white' if candidate.is_recognized else 'red'
                 plt.text(np.average(bquad_corners[:, 0]),
                          np.average(bquad_corners[:, 1]),
@@ -538,9 +899,10 @@ class TestImage:
                          bbox=dict(facecolor=bbox_color,
                                    alpha=0.7))
 
-        plt.savefig(output_path + '/MTG_card_recognition_results_' +
-                    str(self.name.split('.jpg')[0]) +
-                    '.jpg', dpi=600, bbox_inches='tight')
+        if save:
+            plt.savefig(output_path + '/MTG_card_recognition_results_' +
+                        str(self.name.split('.jpg')[0]) +
+                        '.jpg', dpi=600, bbox_inches='tight')
         if visual:
             plt.show()
         plt.close()
@@ -600,31 +962,36 @@ class MagicCardDetector:
 
     def __init__(self, output_path):
         self.reference_images: list[ReferenceImage] = []
+        self.ref_hashes = np.zeros((0, 16), dtype=np.uint64)
+        self.ref_names: list[str] = []
         self.test_images: list[TestImage] = []
         self.output_path = output_path
 
         self.verbose = False
         self.visual = False
+        self.save_results = True
 
         self.hash_separation_thr = 4.
         self.thr_lvl = 70
 
+        # number of parallel workers, None uses all processors
+        self.n_workers = None
+        # the recognition processes are only started for images with at
+        # least this many candidates, fewer do not repay the startup
+        self.min_parallel_candidates = 8
+        self.recognition_pool = None
+
         self.clahe = cv2.createCLAHE(clipLimit=2.0,
                                      tileGridSize=(8, 8))
 
     def export_reference_data(self, path):
         """
         Exports the phash and card name of the reference data list.
+        The list is pickled as it is, so the reference images should be
+        read without keeping the images (as in save_hash.py).
         """
-        hlist: list[ReferenceImage] = []
-        for image in self.reference_images:
-            hlist.append(ReferenceImage(image.name,
-                                        None,
-                                        None,
-                                        image.phash))
-
         with open(path, 'wb') as fhandle:
-            pickle.dump(hlist, fhandle)
+            pickle.dump(self.reference_images, fhandle, protocol=5)
 
     def read_prehashed_reference_data(self, path):
         """
@@ -634,26 +1001,58 @@ class MagicCardDetector:
         print('...', end=' ')
         with open(path, 'rb') as filename:
             hashed_list = pickle.load(filename)
-        for ref_im in hashed_list:
-            self.reference_images.append(
-                ReferenceImage(ref_im.name, None, self.clahe, ref_im.phash))
+        # the unpickled entries only carry the name and the phash, which
+        # are packed into ref_hashes and ref_names for the comparison
+        self.reference_images.extend(hashed_list)
+        self.pack_reference_hashes()
         print('Done.')
 
-    def read_and_adjust_reference_images(self, path):
+    def read_and_adjust_reference_images(self, path, keep_images=True):
         """
         Reads and histogram-adjusts the reference image set.
-        Pre-calculates the hashes of the images.
+        Pre-calculates the hashes of the images. Without keep_images,
+        only the names and the hashes of the reference images are kept
+        (as needed for export_reference_data).
         """
         print('Reading images from ' + str(path))
         print('...', end=' ')
         filenames = glob.glob(path + '*.jpg')
-        for filename in filenames:
-            img = cv2.imread(filename)
-            img_name = filename.split(path)[1]
-            self.reference_images.append(
-                ReferenceImage(img_name, img, self.clahe))
+        # The images are decoded, adjusted and hashed in worker processes
+        # (see read_reference_image_worker), when there are several.
+        n_workers = self.n_workers or os.cpu_count() or 1
+        if n_workers > 1:
+            pool = ProcessPoolExecutor(max_workers=n_workers)
+        else:
+            pool = nullcontext()
+        args = (repeat(path),
+                filenames,
+                repeat(self.clahe.getClipLimit()),
+                repeat(self.clahe.getTilesGridSize()),
+                repeat(keep_images))
+        with pool as executor:
+            if executor is None:
+                images = map(read_reference_image_worker, *args)
+            else:
+                images = executor.map(read_reference_image_worker, *args,
+                                      chunksize=8)
+            self.reference_images.extend(images)
+        self.pack_reference_hashes()
         print('Done.')
 
+    def pack_reference_hashes(self):
+        """
+        Stacks the phashes of the reference images into a packed bit
+        array, ref_hashes (one row per image), and the card names into
+        ref_names, in the same order. The recognition only uses these two;
+        reference_images is kept for exporting the reference data.
+        """
+        if not self.reference_images:
+            return
+        self.ref_hashes = pack_hashes(
+            [ref_im.phash.hash for ref_im in self.reference_images])
+        self.ref_names = [ref_im.name.split('.jpg')[0]
+                          for ref_im in self.reference_images]
+
     def read_and_adjust_test_images(self, path):
         """
         Reads and histogram-adjusts the test image set.
@@ -746,13 +1145,12 @@ class MagicCardDetector:
 
         print("Number of Contours before merge = " + str(len(contours)))
 
-        # Merge contours into one
-        list_of_pts = []
-        for ctr in contours:
-            list_of_pts += [pt[0] for pt in ctr]
-        ctr = np.array(list_of_pts).reshape((-1,1,2)).astype(np.int32)
-        contours = ctr
-        contours = [cv2.convexHull(contours)]
+        # Merge contours into one, (N, 2) array of the points
+        if contours:
+            pts = np.vstack([c.reshape(-1, 2) for c in contours])
+        else:
+            pts = np.empty((0, 2), dtype=np.int32)
+        contours = [cv2.convexHull(pts)]
 
         print("Number of Contours after merge = " + str(len(contours)))
         return contours
@@ -795,105 +1193,85 @@ class MagicCardDetector:
         max_segment_area = 0.01  # largest card area
 
         contours = self.contour_image(full_image, mode=contouring_mode)
-        for card_contour in contours:
-            try:
-                (continue_segmentation,
-                 is_card_candidate,
-                 bounding_poly,
-                 crop_factor) = characterize_card_contour(card_contour,
-                                                          max_segment_area,
-                                                          image_area)
-            except NotImplementedError as nie:
-                # this can occur in Shapely for some funny contour shapes
-                # resolve by discarding the candidate
-                print("NotImplementedError")
-                print(nie)
-                (continue_segmentation,
-                 is_card_candidate,
-                 bounding_poly,
-                 crop_factor) = (True, False, None, 1.)
-            except ValueError as ve:
-                # this can occur if the contour is out of bounds
-                # resolve by discarding the candidate
-                print("ValueError")
-                print(ve)
-                (continue_segmentation,
-                 is_card_candidate,
-                 bounding_poly,
-                 crop_factor) = (True, False, None, 1.)
-            if not continue_segmentation:
-                break
-            if is_card_candidate:
-                if self.verbose:
-                    print('max_segment_area=' + str(max_segment_area))
-                    print('bounding_poly.area=' + str(bounding_poly.area))
-                if max_segment_area < 0.1:
-                    max_segment_area = bounding_poly.area
-                warped = four_point_transform(full_image,
-                                              scale(bounding_poly,
-                                                    xfact=crop_factor,
-                                                    yfact=crop_factor,
-                                                    origin='centroid'))
-                test_image.candidate_list.append(
-                    CardCandidate(warped,
-                                  bounding_poly,
-                                  bounding_poly.area / image_area))
-                if self.verbose:
-                    print('Segmented ' +
-                          str(len(test_image.candidate_list)) +
-                          ' candidates.')
-
-    def phash_diff(self, phash_im):
-        """
-        Calculates the phash difference between the given phash and
-        each of the reference images.
-        """
-        diff = np.zeros(len(self.reference_images))
-        for i, ref_im in enumerate(self.reference_images):
-            diff[i] = phash_im - ref_im.phash
-        return diff
+        # The hulls and bounding quads of the contours are independent,
+        # so they are calculated ahead in parallel threads, in the order
+        # in which they are used. Only a few contours are calculated ahead,
+        # since the loop stops once the card size range is explored.
+        # The shapely polygons are only built here, in the main thread.
+        n_ahead = self.n_workers or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=n_ahead) as executor:
+            bounded_contours = deque(
+                executor.submit(bound_card_contour, card_contour, image_area)
+                for card_contour in contours[:n_ahead])
+            for i_contour, card_contour in enumerate(contours):
+                bounded_contour = bounded_contours.popleft()
+                if i_contour + n_ahead < len(contours):
+                    bounded_contours.append(executor.submit(
+                        bound_card_contour,
+                        contours[i_contour + n_ahead],
+                        image_area))
+                try:
+                    (continue_segmentation,
+                     is_card_candidate,
+                     bounding_poly,
+                     crop_factor) = characterize_card_contour(
+                         card_contour,
+                         max_segment_area,
+                         image_area,
+                         bounded_contour.result())
+                except NotImplementedError as nie:
+                    # this can occur in Shapely for some funny contour shapes
+                    # resolve by discarding the candidate
+                    print("NotImplementedError")
+                    print(nie)
+                    (continue_segmentation,
+                     is_card_candidate,
+                     bounding_poly,
+                     crop_factor) = (True, False, None, 1.)
+                except ValueError as ve:
+                    # this can occur if the contour is out of bounds
+                    # resolve by discarding the candidate
+                    print("ValueError")
+                    print(ve)
+                    (continue_segmentation,
+                     is_card_candidate,
+                     bounding_poly,
+                     crop_factor) = (True, False, None, 1.)
+                if not continue_segmentation:
+                    break
+                if is_card_candidate:
+                    if self.verbose:
+                        print('max_segment_area=' + str(max_segment_area))
+                        print('bounding_poly.area=' + str(bounding_poly.area))
+                    if max_segment_area < 0.1:
+                        max_segment_area = bounding_poly.area
+                    warped = four_point_transform(full_image,
+                                                  scale(bounding_poly,
+                                                        xfact=crop_factor,
+                                                        yfact=crop_factor,
+                                                        origin='centroid'))
+                    test_image.candidate_list.append(
+                        CardCandidate(warped,
+                                      bounding_poly,
+                                      bounding_poly.area / image_area))
+                    if self.verbose:
+                        print('Segmented ' +
+                              str(len(test_image.candidate_list)) +
+                              ' candidates.')
+
+            for bounded_contour in bounded_contours:
+                bounded_contour.cancel()
 
     def phash_compare(self, im_seg):
         """
         Runs perceptive hash comparison between given image and
         the (pre-hashed) reference set.
         """
-
-        card_name = 'unknown'
-        is_recognized = False
-        recognition_score = 0.
-        recognition_rotation: float = 0.
-        rotations = np.array([0., 90., 180., 270.])
-
-        d_0_dist = np.zeros(len(rotations))
-        d_0 = np.zeros((len(self.reference_images), len(rotations)))
-        for j, rot in enumerate(rotations):
-            if not -1.e-5 < rot < 1.e-5:
-                phash_im = imagehash.phash(
-                    PILImage.fromarray(np.uint8(255 * cv2.cvtColor(
-                        rotate(im_seg, rot), cv2.COLOR_BGR2RGB))),
-                    hash_size=32)
-            else:
-                phash_im = imagehash.phash(
-                    PILImage.fromarray(np.uint8(255 * cv2.cvtColor(
-                        im_seg, cv2.COLOR_BGR2RGB))),
-                    hash_size=32)
-            d_0[:, j] = self.phash_diff(phash_im)
-            d_0_ = d_0[d_0[:, j] > np.amin(d_0[:, j]), j]
-            d_0_ave = np.average(d_0_)
-            d_0_std = np.std(d_0_)
-            d_0_dist[j] = (d_0_ave - np.amin(d_0[:, j])) / d_0_std
-            if self.verbose:
-                print('Phash statistical distance: ' + str(d_0_dist[j]))
-            if (d_0_dist[j] > self.hash_separation_thr and
-                    np.argmax(d_0_dist) == j):
-                card_name = self.reference_images[np.argmin(d_0[:, j])]\
-                    .name.split('.jpg')[0]
-                is_recognized = True
-                recognition_score = d_0_dist[j] / self.hash_separation_thr
-                recognition_rotation = rot
-                break
-        return (is_recognized, recognition_score, card_name, recognition_rotation)
+        return phash_recognize(im_seg,
+                               self.ref_hashes,
+                               self.ref_names,
+                               self.hash_separation_thr,
+                               self.verbose)
 
     def recognize_segment(self, image_segment):
         """
@@ -910,32 +1288,64 @@ class MagicCardDetector:
             image_index = range(len(self.test_images))
         elif not isinstance(image_index, list):
             image_index = [image_index]
-        for i in image_index:
-            test_image = self.test_images[i]
-            print('\nAccessing image ' + test_image.name)
-
-            if self.visual:
-                print('Original image')
-                plt.imshow(cv2.cvtColor(test_image.original,
-                                        cv2.COLOR_BGR2RGB))
-                plt.show()
-
-            # Algorithms: adaptive, rgp, merge
-            alg_list = ['merge']
-
-            for alg in alg_list:
-                self.recognize_cards_in_image(test_image, alg)
-                test_image.discard_unrecognized_candidates()
-                if (not test_image.may_contain_more_cards() or
-                        len(test_image.return_recognized()) > 5):
-                    break
-
-            print('Plotting and saving the results...')
-            test_image.plot_image_with_recognized(self.output_path, self.visual)
-            print('Done.')
-            test_image.print_recognized()
+        # The recognition worker processes are started on first use (see
+        # recognition_executor), and then kept for all the images.
+        try:
+            for i in image_index:
+                test_image = self.test_images[i]
+                print('\nAccessing image ' + test_image.name)
+
+                if self.visual:
+                    print('Original image')
+                    plt.imshow(cv2.cvtColor(test_image.original,
+                                            cv2.COLOR_BGR2RGB))
+                    plt.show()
+
+                # Algorithms: adaptive, rgp, merge
+                alg_list = ['merge']
+
+                for alg in alg_list:
+                    self.recognize_cards_in_image(test_image, alg)
+                    test_image.discard_unrecognized_candidates()
+                    if (not test_image.may_contain_more_cards() or
+                            len(test_image.return_recognized()) > 5):
+                        break
+
+                if self.visual or self.save_results:
+                    print('Plotting and saving the results...')
+                    test_image.plot_image_with_recognized(self.output_path,
+                                                          self.visual,
+                                                          self.save_results)
+                    print('Done.')
+                test_image.print_recognized()
+        finally:
+            if self.recognition_pool is not None:
+                self.recognition_pool.shutdown()
+                self.recognition_pool = None
         print('Recognition done.')
 
+    def recognition_executor(self, n_candidates):
+        """
+        Returns the process pool in which n_candidates candidates are
+        recognized, or None if they are recognized serially, that is, with
+        a single worker or fewer than min_parallel_candidates candidates.
+        The pool is started on first use, and shut down at the end of
+        run_recognition (also when started by a direct call of
+        recognize_cards_in_image).
+        """
+        n_workers = self.n_workers or os.cpu_count() or 1
+        if n_workers < 2 or n_candidates < self.min_parallel_candidates:
+            return None
+        if self.recognition_pool is None:
+            self.recognition_pool = ProcessPoolExecutor(
+                max_workers=n_workers,
+                initializer=init_recognition_worker,
+                initargs=(self.ref_hashes,
+                          self.ref_names,
+                          self.hash_separation_thr,
+                          self.verbose))
+        return self.recognition_pool
+
     def recognize_cards_in_image(self, test_image, contouring_mode):
         """
         Tries to recognize cards from the image specified.
@@ -952,29 +1362,36 @@ class MagicCardDetector:
               str(len(test_image.candidate_list)) + ' candidates.')
         print('Recognizing candidates.')
 
-        for i_cand, candidate in enumerate(test_image.candidate_list):
+        to_recognize: list[CardCandidate] = []
+        for candidate in test_image.candidate_list:
             im_seg = candidate.image
-            if self.verbose:
-                print(str(i_cand + 1) + " / " +
-                      str(len(test_image.candidate_list)))
-
             # Assume entire card is within origoinal image and ignore larger
             if (im_seg.shape[1] > test_image.original.shape[1] or
                     im_seg.shape[0] > test_image.original.shape[0]):
                 continue
             print("im_seg: Width: " + str(im_seg.shape[0]) + " Height: " + str(im_seg.shape[1]))
-
-            # Easy fragment / duplicate detection
-            for other_candidate in test_image.candidate_list:
-                if (other_candidate.is_recognized and
-                        not other_candidate.is_fragment):
-                    if other_candidate.contains(candidate):
-                        candidate.is_fragment = True
-            if not candidate.is_fragment:
+            to_recognize.append(candidate)
+
+        # The candidates are recognized independently of each other,
+        # in parallel processes when there are enough of them.
+        executor = self.recognition_executor(len(to_recognize))
+        if executor is None:
+            results = map(self.recognize_segment,
+                          [candidate.image for candidate in to_recognize])
+            for candidate, result in zip(to_recognize, results):
+                (candidate.is_recognized,
+                 candidate.recognition_score,
+                 candidate.name,
+                 candidate.rotation) = result
+        else:
+            results = executor.map(
+                recognize_segment_worker,
+                [candidate.image for candidate in to_recognize])
+            for candidate, result in zip(to_recognize, results):
                 (candidate.is_recognized,
                  candidate.recognition_score,
                  candidate.name,
-                 candidate.rotation) = self.recognize_segment(im_seg)
+                 candidate.rotation) = result
 
         print('Done. Found ' +
               str(len(test_image.return_recognized())) +
@@ -1013,6 +1430,11 @@ def main():
                         help='run with visualization')
     parser.add_argument('--verbose', default=False, action='store_true',
                         help='run in verbose mode')
+    parser.add_argument('--no_save', default=False, action='store_true',
+                        help='do not save the result images')
+    parser.add_argument('--n_workers', type=int, default=None,
+                        help='number of worker processes and threads, ' +
+                             'all processors by default')
 
     args = parser.parse_args()
 
@@ -1040,6 +1462,8 @@ def main():
     do_profile = False
     card_detector.visual = args.visual
     card_detector.verbose = args.verbose
+    card_detector.save_results = not args.no_save
+    card_detector.n_workers = args.n_workers
 
     # Read the reference and test data sets
     # card_detector.read_and_adjust_reference_images(
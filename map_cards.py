@@ -1,35 +1,65 @@
 import csv
 import argparse
-import os
 import logging
+import os
 import re
+import sys
+from dataclasses import dataclass, field
+from functools import lru_cache, total_ordering
+from pathlib import Path
 
-class Card:
-    # Class representing a card in the collection
+log = logging.getLogger(__name__)
+
+_COLNUM_RE = re.compile(r"([0-9]+)([a-z]*)")
+
+def collector_number_key(collector_number):
+    # Integer sort key of a collector number, e.g. "10a" -> (10 << 8) | ord("a").
+    # Numbers that can not be parsed (no card, "-1") sort first.
+    re_number = _COLNUM_RE.match(collector_number)
+    if (re_number is None):
+        return -1
+    suffix = re_number.group(2)
+    return (int(re_number.group(1)) << 8) | (ord(suffix[0]) if suffix else 0)
 
-    def __init__(self, name, image_rotation, set_acrynm, image_file):
-        self.name: str = name
-        self.set_acrynm: str = set_acrynm
-        self.image_file: str = image_file
-        self.scan_rotation: str = image_rotation
 
-        self.collector_number: str = "-1"
+@total_ordering
+@dataclass(slots=True, eq=False)
+class Card:
+    # Class representing a card in the collection
+    name: str
+    scan_rotation: str
+    set_acrynm: str
+    image_file: str
+    _collector_number: str = field(default="-1", init=False, repr=False)
+    _sort_key: int = field(default=-1, init=False, repr=False)
+
+    def __post_init__(self):
+        # Shared by most of the cards in a collection, so only one copy
+        # of each value is kept
+        self.set_acrynm = sys.intern(self.set_acrynm)
+        self.scan_rotation = sys.intern(self.scan_rotation)
+
+    @property
+    def collector_number(self) -> str:
+        return self._collector_number
+
+    @collector_number.setter
+    def collector_number(self, collector_number: str):
+        self._collector_number = collector_number
+        self._sort_key = collector_number_key(collector_number)
+
+    @property
+    def has_collector_number(self) -> bool:
+        # False for cards without a detection or not in the set list
+        return self._sort_key >= 0
 
     def __str__(self):
         return f"<Card name:{self.name} set_acrynm:{self.set_acrynm} image_file:{self.image_file} collector_number:{self.collector_number}>"
 
     def __lt__(self, other):
-        return self.collector_number < other.collector_number
-    def __le__(self, other):
-        return self.collector_number <= other.collector_number
+        return self._sort_key < other._sort_key
     def __eq__(self, other):
-        return self.collector_number == other.collector_number
-    def __ne__(self, other):
-        return self.collector_number != other.collector_number
-    def __gt__(self, other):
-        return self.collector_number > other.collector_number
-    def __ge__(self, other):
-        return self.collector_number >= other.collector_number
+        return self._sort_key == other._sort_key
 
 
 def open_set_list(set_list_filename):
@@ -37,78 +67,120 @@ def open_set_list(set_list_filename):
     with open(set_list_filename) as set_list_file:
         reader = csv.reader(set_list_file, delimiter=';')
         set_list = dict(reader)
-        logging.info("Set list read from: " + set_list_filename)
+        log.info("Set list read from: %s", set_list_filename)
     return set_list
 
-def open_collection_list(input_cards_filename):
-    collection_list = []
-    with open(input_cards_filename) as input_cards_file:
+def read_collection_rows(input_cards_file, pd):
+    # Yields the first four fields of each row, in chunks with pandas
+    if pd is None:
         reader = csv.reader(input_cards_file, delimiter=';')
-        logging.info("Detected cards read from: " + input_cards_filename)
         for card in reader:
+            yield card[:4]
+        return
+    try:
+        chunks = pd.read_csv(input_cards_file, sep=';', header=None,
+                             usecols=range(4), dtype=str,
+                             na_filter=False, engine='c', chunksize=10000)
+        for df in chunks:
+            yield from zip(*(df[col].values for col in range(4)))
+    except pd.errors.EmptyDataError:
+        return
+
+def open_collection_list(input_cards_filename):
+    # Generator of the detected cards, the file is read as the cards are
+    # consumed
+    try:
+        # pandas is optional, its C parser is faster for large collections
+        import pandas as pd
+    except ImportError:
+        pd = None
+    with open(input_cards_filename) as input_cards_file:
+        log.info("Detected cards read from: %s", input_cards_filename)
+        debug = log.isEnabledFor(logging.DEBUG)
+        for card in read_collection_rows(input_cards_file, pd):
             new_card = Card(card[0], card[1], card[2], card[3])
-            collection_list.append(new_card)
-            logging.debug(new_card)
-    return collection_list
+            if (debug):
+                log.debug("%s", new_card)
+            yield new_card
+
+def find_collector_number(collection, set_list):
+    # Cards without a detection, or with a name not in the set list,
+    # keep the collector number "-1"
+    # Repeated printings of a card are only looked up once. The cache is
+    # local to the call, so a changed set list is never served stale.
+    @lru_cache(maxsize=None)
+    def lookup(name):
+        return set_list.get(name, "-1")
 
-def find_collector_number(collection_list, set_list):
-    for card in collection_list:
+    for card in collection:
+        number = lookup(card.name)
         if (card.name == ''):
-            logging.error("Card detection missing in " + card.image_file)
+            log.error("Card detection missing in %s", card.image_file)
+        elif (number == "-1"):
+            log.error("Card not in set list: %s in %s", card.name, card.image_file)
         else:
-            card.collector_number = set_list[card.name]
-    return collection_list
+            card.collector_number = number
+        yield card
 
 def print_collection(collection, output_cards_filename):
-    f = open(output_cards_filename, "w")
-    for card in collection:
-        f.write(card.set_acrynm + ";" + card.collector_number + "\n")
-        logging.debug(card)
-    f.close()
+    # The collection is streamed, so an error upstream (e.g. in the checks)
+    # can be raised in the middle of writing. The rows go to a temporary
+    # file, which only replaces the output file when all cards are written.
+    tmp_filename = str(output_cards_filename) + ".tmp"
+    try:
+        with open(tmp_filename, "w", newline="") as f:
+            writer = csv.writer(f, delimiter=';', lineterminator='\n')
+            writer.writerows((card.set_acrynm, card.collector_number)
+                             for card in collection)
+        os.replace(tmp_filename, output_cards_filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    log.debug("Collection written to: %s", output_cards_filename)
     return
 
-def check_names(collection):
-    error_cards: list[Card] = []
-    for card in collection:
-        if (card.name == ''):
-            logging.error("Card missing name: " + card.image_file)
-            error_cards.append(card)
-    return error_cards
-
-def check_collector_number(collection):
-    max_number = str(collection[0].collector_number)
-    re_max = re.search(r"([0-9]+)([a-z]*)", max_number)
-    error_cards: list[Card] = []
-    for card in collection:
-        re_card  = re.search(r"([0-9]+)([a-z]*)", max_number)
-        if (re_card.group(1) < re_max.group(1) or (re_card.group(1) == re_max.group(1) and re_card.group(2) < re_max.group(2))):
-            logging.error("Card Collector Number Decreases: " + card.image_file)
-            logging.error("Collector Number Decreases from: " + str(re_max.groups()) + " to " + str(re_card.groups()))
-            error_cards.append(card)
-        else:
-            re_max = re_card
-    return error_cards
-
-def check_orientation(collection):
+def checked_collection(collection, errors=None):
+    # All checks are done in a single pass over the collection, the cards
+    # are passed on as they are checked. The cards failing the checks are
+    # appended to errors, (name_errors, number_errors, orientation_errors),
+    # if given.
+    (name_errors, number_errors, orientation_errors) = \
+        errors if errors is not None else ([], [], [])
+    max_card = None
     scan_orientation = None
-    error_cards: list[Card] = []
     for card in collection:
+        # Check missing names
+        if (card.name == ''):
+            log.error("Card missing name: %s", card.image_file)
+            name_errors.append(card)
+
+        # Check increasing collector numbers, in the order of the cards.
+        # Cards without a collector number are reported by the name check.
+        if (card.has_collector_number):
+            if (max_card is not None and card < max_card):
+                log.error("Card Collector Number Decreases: %s", card.image_file)
+                log.error("Collector Number Decreases from: %s to %s", max_card.collector_number, card.collector_number)
+                number_errors.append(card)
+            else:
+                max_card = card
+
+        # Check card identification orientation
         if (card.scan_rotation != ""):
             if (scan_orientation == None):
                 scan_orientation = float(card.scan_rotation)
             if (float(card.scan_rotation) != scan_orientation):
-                logging.error("Card Rotation not consistent: " + card.image_file)
-                error_cards.append(card)
-    return error_cards
+                log.error("Card Rotation not consistent: %s", card.image_file)
+                orientation_errors.append(card)
+        yield card
 
 def check_collection(collection):
-    # Check missing names
-    check_names(collection)
-    # Check increasing collector numbers
-    check_collector_number(collection)
-    # Check card identification orientation
-    check_orientation(collection)
-    return
+    # Checks the whole collection at once, see checked_collection for
+    # checking the cards as they are streamed
+    errors: tuple[list[Card], list[Card], list[Card]] = ([], [], [])
+    for card in checked_collection(collection, errors):
+        pass
+    return errors
 
 
 
@@ -135,6 +207,7 @@ def main():
 
     args = parser.parse_args()
 
+    logging.basicConfig()
     if (args.debug):
         logging.getLogger().setLevel(logging.DEBUG)
     else:
@@ -142,21 +215,22 @@ def main():
 
     set_name = args.set_name
 
-    set_list_filename = os.path.join(args.set_list_path, set_name + ".csv");
-    input_cards_filename = os.path.join(args.input_path, "cards_" + set_name + ".csv");
-    output_cards_filename = os.path.join(args.output_path, set_name + ".csv");
+    output_path = Path(args.output_path)
+    set_list_filename = Path(args.set_list_path) / f"{set_name}.csv"
+    input_cards_filename = Path(args.input_path) / f"cards_{set_name}.csv"
+    output_cards_filename = output_path / f"{set_name}.csv"
 
-    if not os.path.exists(args.output_path):
-        os.mkdir(args.output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
 
     set_list = open_set_list(set_list_filename)
 
-    collection_list = open_collection_list(input_cards_filename)
-    collection_list = find_collector_number(collection_list, set_list)
-
-    check_collection(collection_list)
+    # The cards are streamed from the input file through the mapping and
+    # the checks to the output file
+    collection = open_collection_list(input_cards_filename)
+    collection = find_collector_number(collection, set_list)
+    collection = checked_collection(collection)
 
-    print_collection(collection_list, output_cards_filename)
+    print_collection(collection, output_cards_filename)
 
 
 
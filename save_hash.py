@@ -1,20 +1,11 @@
-import pickle
 import argparse
 import magic_card_detector as mcg
 
-def makeHash(path, name):
+def makeHash(path, name, n_workers=None):
     card_detector = mcg.MagicCardDetector('./')
-    card_detector.read_and_adjust_reference_images(path)
-
-    hlist = []
-    for image in card_detector.reference_images:
-        image.original = None
-        image.clahe = None
-        image.adjusted = None
-        hlist.append(image)
-
-    with open(name, 'wb') as f:
-        pickle.dump(hlist, f)
+    card_detector.n_workers = n_workers
+    card_detector.read_and_adjust_reference_images(path, keep_images=False)
+    card_detector.export_reference_data(name)
 
 def main():
     """
@@ -28,11 +19,14 @@ def main():
                         help='path containing the images to be hashed')
     parser.add_argument('name',
                         help='name of data file to create')
+    parser.add_argument('--n_workers', type=int, default=None,
+                        help='number of worker processes, all processors ' +
+                             'by default')
 
     args = parser.parse_args()
 
     #makeHash(args.input_path, args.name)
-    makeHash(args.input_path, args.name)
+    makeHash(args.input_path, args.name, args.n_workers)
 
 if __name__ == "__main__":
     main()
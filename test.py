@@ -1,6 +1,24 @@
+import argparse
+
 import numpy as np
 import cv2
 
+parser = argparse.ArgumentParser(
+    description='Merge the contours of a card image into its convex hull.')
+parser.add_argument('--debug', default=False, action='store_true',
+                    help='show the intermediate images')
+DEBUG = parser.parse_args().debug
+
+
+def show(window_name, img):
+    # Only shown in debug mode, the windows block until a key is pressed
+    if DEBUG:
+        cv2.imshow(window_name, img)
+        cv2.waitKey(0)
+
+
+cv2.setUseOptimized(True)
+
 image = cv2.imread('test/card_0315.jpg')
 assert image is not None, "file could not be read, check with os.path.exists()"
 
@@ -9,11 +27,15 @@ assert image is not None, "file could not be read, check with os.path.exists()"
 #ret, thresh = cv2.threshold(imgray, 127, 255, 0)
 #contours, hierarchy = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
 
+# Buffers for the grayscale and edge images
+gray = np.empty(image.shape[:2], dtype=np.uint8)
+edged = np.empty_like(gray)
+
 # Grayscale
-gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=gray)
 
 # Find Canny edges
-edged = cv2.Canny(gray, 100, 200)
+cv2.Canny(gray, 100, 200, edges=edged)
 
 # Finding Contours
 # Use a copy of the image e.g. edged.copy()
@@ -21,31 +43,34 @@ edged = cv2.Canny(gray, 100, 200)
 contours, hierarchy = cv2.findContours(edged, cv2.RETR_EXTERNAL,
                                        cv2.CHAIN_APPROX_NONE)
 
-cv2.imshow('Canny Edges After Contouring', edged)
-cv2.waitKey(0)
+try:
+    show('Canny Edges After Contouring', edged)
 
-print("Number of Contours found = " + str(len(contours)))
+    print("Number of Contours found = " + str(len(contours)))
 
-# Merge contours into one
-list_of_pts = []
-for ctr in contours:
-    list_of_pts += [pt[0] for pt in ctr]
-ctr = np.array(list_of_pts).reshape((-1,1,2)).astype(np.int32)
-contours = ctr
+    # Merge contours into one, (N, 2) array of the points
+    if contours:
+        pts = np.vstack([c.reshape(-1, 2) for c in contours])
+    else:
+        pts = np.empty((0, 2), dtype=np.int32)
 
-image_copy = image.copy()
-cv2.drawContours(image_copy, contours, -1, (0, 255, 0), 3)
-cv2.imshow('Contours', image_copy)
-cv2.waitKey(0)
+    if DEBUG:
+        # every point drawn as a contour of its own
+        image_copy = image.copy()
+        cv2.drawContours(image_copy, pts[:, np.newaxis], -1, (0, 255, 0), 3)
+        show('Contours', image_copy)
 
-contours = [cv2.convexHull(contours)]
+    contours = [cv2.convexHull(pts)]
 
-print("Number of Contours found after merge = " + str(len(contours)))
+    print("Number of Contours found after merge = " + str(len(contours)))
 
-# Draw all contours
-# -1 signifies drawing all contours
+    # Draw all contours
+    # -1 signifies drawing all contours
 
-cv2.drawContours(image, contours, -1, (0, 255, 0), 3)
-cv2.imshow('Contours', image)
-cv2.waitKey(0)
-cv2.destroyAllWindows()
+    if DEBUG:
+        # the image is not needed after this, so the hull is drawn in place
+        cv2.drawContours(image, contours, -1, (0, 255, 0), 3)
+        show('Contours', image)
+finally:
+    if DEBUG:
+        cv2.destroyAllWindows()